@@ -1,6 +1,8 @@
 import logging
-import random
+import os
+import sys
 import threading
+from collections import namedtuple
 from copy import deepcopy
 
 from cvv.vtypes import Version, VersionSet, VersionVector
@@ -26,7 +28,13 @@ class ConcurrentUpdateException(Exception):
 
 
 class ReadTuple:
-    def __init__(self, dependent_versions=VersionVector(), values=[]):
+    __slots__ = ('dependent_versions', 'values')
+
+    def __init__(self, dependent_versions=None, values=None):
+        if dependent_versions is None:
+            dependent_versions = VersionVector()
+        if values is None:
+            values = []
         self.dependent_versions = dependent_versions
         self.values = values
 
@@ -36,74 +44,91 @@ class ReadTuple:
 
 
 class ObjectVersion:
-    def __init__(self, version=Version(), timestamp=VersionVector(),
-                 value=None):
+    """A single version of an object. Object versions are shared between the
+       data store and messages so they must not be modified once they have
+       been inserted into an ObjectRecord."""
+    __slots__ = ('version', 'timestamp', 'value')
+
+    def __init__(self, version, timestamp, value=None):
         self.version = version
         self.timestamp = timestamp
         self.value = value
 
+    def replace_timestamp(self, timestamp):
+        """Returns a copy of this object version with a different
+           timestamp."""
+        return ObjectVersion(self.version, timestamp, self.value)
+
     def __str__(self):
         return "{ v=%s, ts=%s, %s }" % \
             (self.version, self.timestamp, str(self.value))
 
 
 class ObjectRecord:
-    def __init__(self):
-        self.versions = []
+    """The set of stored versions of one object. Records are never modified
+       once they have been stored; updates build a new record instead.
+       The only exception is visible_cache, which memoizes the result of
+       Replica._filter_visible_versions for the record."""
+    __slots__ = ('versions', 'visible_cache')
+
+    def __init__(self, versions=()):
+        self.versions = versions
+        self.visible_cache = None
 
     def __str__(self):
         return str(self.versions)
 
 
-class UpdateMessage:
-    def __init__(self, key, obj_ver):
-        self.key = key
-        self.obj_ver = obj_ver
+# Stands in for objects that aren't in the data store. Records are never
+# modified and the visible versions of an empty record are the same for every
+# replica so a single instance can be shared.
+EMPTY_OBJECT_RECORD = ObjectRecord()
+
+
+# Messages are immutable tuples shared with the receiving replica which must
+# treat everything they reference as read-only.
 
 
-class SyncRequestMessage:
+class UpdateMessage(namedtuple('UpdateMessage', ['key', 'obj_ver'])):
+    __slots__ = ()
+
+
+class SyncRequestMessage(namedtuple('SyncRequestMessage',
+        ['cookie', 'requestor_knowledge'])):
     """This message is sent between replicas to request a state sync"""
-    def __init__(self, cookie, requestor_knowledge):
-        self.cookie = cookie
-        self.requestor_knowledge = requestor_knowledge
+    __slots__ = ()
 
 
-class SyncResponseSetupMessage:
+class SyncResponseSetupMessage(namedtuple('SyncResponseSetupMessage',
+        ['cookie', 'server_knowledge', 'server_visible'])):
     """This message is sent in response to a sync request to begin the sync."""
-    def __init__(self, cookie, server_knowledge, server_visible):
-        self.cookie = cookie
-        self.server_knowledge = server_knowledge
-        self.server_visible = server_visible
+    __slots__ = ()
 
 
-class SyncResponseDataMessage:
-    """This message contains the data for one object version in a state sync"""
-    def __init__(self, cookie, key, obj_ver):
-        self.cookie = cookie
-        self.key = key
-        self.obj_ver = obj_ver
+class SyncResponseDataBatchMessage(namedtuple('SyncResponseDataBatchMessage',
+        ['cookie', 'items'])):
+    """This message contains the data for several object versions in a state
+       sync. items is a tuple of (key, obj_ver) tuples."""
+    __slots__ = ()
 
 
-class SyncResponseCompleteMessage:
+class SyncResponseCompleteMessage(namedtuple('SyncResponseCompleteMessage',
+        ['cookie'])):
     """This message marks the end of a complete state sync."""
-    def __init__(self, cookie):
-        self.cookie = cookie
+    __slots__ = ()
 
 
 class SimDataStore:
-    """Interface to persistent KV store. Also keeps object references in check
-       by always creating copies of the objects read & written"""
+    """Interface to persistent KV store. The stored ObjectRecords are
+       immutable so they are shared with the caller rather than copied."""
     def __init__(self):
         self.data = {}
 
-    def get(self, key):
-        try:
-            return deepcopy(self.data[key])
-        except KeyError:
-            return None
+    def get(self, key, default=None):
+        return self.data.get(key, default)
 
     def put(self, key, value):
-        self.data[key] = deepcopy(value)
+        self.data[key] = value
 
     def erase(self, key):
         del self.data[key]
@@ -111,23 +136,53 @@ class SimDataStore:
     def iterkeys(self):
         return self.data.keys()
 
+    def iteritems(self):
+        return self.data.items()
+
+
+# Number of locks that object keys are spread over
+KEY_LOCK_STRIPES = 64
+
+# Maximum number of object versions sent in one sync data message
+SYNC_BATCH_SIZE = 32
+
 
 class Replica:
     def __init__(self, replica_id, msg_bus):
         self.logger = logging.getLogger("Replica-%s" % replica_id)
+        # The replica ID ends up as a key in every version vector and set so
+        # intern it to let dict lookups match it by identity
+        if isinstance(replica_id, str):
+            replica_id = sys.intern(replica_id)
         self.replica_id = replica_id
         self.msg_bus = msg_bus
+
+        # Changes to a single object are serialized by the key lock for
+        # that object, chosen from a fixed set of striped locks. update_lock
+        # protects the replica-wide state: knowledge, visible,
+        # committed_visible and their epochs. When both are needed the key
+        # lock must be acquired first.
+        self.key_locks = [threading.Lock() for _ in range(KEY_LOCK_STRIPES)]
         self.update_lock = threading.Lock()
 
         # TODO Load persistent state
         self.db = SimDataStore()
         self.knowledge = VersionSet()
         self.committed_visible = VersionVector()
-        assert self.knowledge.get_version(self.replica_id) == \
-            self.committed_visible.get_version(self.replica_id)
+        assert self.knowledge.get_counter(self.replica_id) == \
+            self.committed_visible.get_counter(self.replica_id)
         assert self.knowledge.dominates_vv(self.committed_visible)
 
-        self.visible = deepcopy(self.committed_visible)
+        self.visible = self.committed_visible.snapshot()
+
+        # A read-only copy of committed_visible that is shared by everything
+        # needing one until committed_visible changes. Created on demand.
+        self.committed_visible_copy = None
+
+        # Bumped whenever self.visible or self.knowledge is modified so
+        # cached visibility results can be invalidated
+        self.visible_epoch = 0
+        self.knowledge_epoch = 0
 
         # Initialize sync requestor state
         self.sync_in_progress = False
@@ -136,6 +191,20 @@ class Replica:
         self.sync_replica_visible = None
         self.sync_replica_knowledge = None
 
+        # Sync cookies only need to be unique per sync request. The salt
+        # keeps them from repeating across restarts of the replica.
+        self.next_sync_cookie = 0
+        self.sync_cookie_salt = int.from_bytes(os.urandom(4), 'little')
+
+        self.message_handlers = {
+            UpdateMessage: self._process_update,
+            SyncRequestMessage: self._process_sync_request,
+            SyncResponseSetupMessage: self._process_sync_response_setup,
+            SyncResponseDataBatchMessage:
+                self._process_sync_response_data_batch,
+            SyncResponseCompleteMessage: self._process_sync_response_complete,
+        }
+
     def read(self, key):
         """Reads the value(s) of the given key. Returns a ReadTuple with
            the values and their associated update dependency versions.
@@ -144,18 +213,23 @@ class Replica:
            ReadTuple is returned."""
         assert key is not None
 
-        result = ReadTuple()
         obj_record = self.db.get(key)
         if obj_record is None:
-            return result
+            return ReadTuple()
+
+        self.update_lock.acquire()
+        try:
+            dependent_versions, values = \
+                self._filter_visible_versions(obj_record)
+        finally:
+            self.update_lock.release()
 
-        result.dependent_versions, result.values = \
-            self._filter_visible_versions(obj_record)
         # If all the values are tombstones then just return an empty list
-        for v in result.values:
+        for v in values:
             if v is not None:
-                # At least one value is not a tombstone
-                return result
+                # At least one value is not a tombstone. The result may be
+                # cached on the record so give the caller copies.
+                return ReadTuple(dependent_versions.snapshot(), list(values))
 
         return ReadTuple()
 
@@ -171,32 +245,16 @@ class Replica:
         assert key is not None
         assert value is not None
 
-        self.logger.debug("create('%s', %s)", key, value)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("create('%s', %s)", key, value)
 
-        self.update_lock.acquire()
+        key_lock = self._key_lock(key)
+        key_lock.acquire()
         try:
-            obj_record = self.db.get(key)
-            if obj_record is not None:
-                # We don't require the caller to explicitly give us the
-                # dependent versions for the operation. It's a create so there
-                # really aren't any dependent versions from the caller's
-                # perspective.
-                #
-                # However, if we are internally storing tombstones then those
-                # have to be the dependent versions so the create occurs
-                # causally after the previous deletions.
-                dependent_versions, visible_values = \
-                    self._filter_visible_versions(obj_record)
-                for v in visible_values:
-                    if v is not None:
-                        raise DuplicateKeyException()
-            else:
-                dependent_versions = VersionVector()
-                obj_record = ObjectRecord()
-            return self._local_update(obj_record, key, value,
-                                      dependent_versions)
+            obj_record = self.db.get(key, EMPTY_OBJECT_RECORD)
+            return self._local_update(obj_record, key, value, None)
         finally:
-            self.update_lock.release()
+            key_lock.release()
 
     def update(self, key, value, dependent_versions):
         """Updates the value of the object with the given key. An object
@@ -217,10 +275,12 @@ class Replica:
         assert value is not None
         assert type(dependent_versions) is VersionVector
 
-        self.logger.debug("update('%s', %s, %s)", key, value,
-            dependent_versions)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("update('%s', %s, %s)", key, value,
+                dependent_versions)
 
-        self.update_lock.acquire()
+        key_lock = self._key_lock(key)
+        key_lock.acquire()
         try:
             obj_record = self.db.get(key)
             if obj_record is None:
@@ -228,7 +288,7 @@ class Replica:
             return self._local_update(obj_record, key, value,
                                       dependent_versions)
         finally:
-            self.update_lock.release()
+            key_lock.release()
 
     def delete(self, key, dependent_versions):
         """Deletes the object identified by the given key.
@@ -244,15 +304,17 @@ class Replica:
         assert key is not None
         assert type(dependent_versions) is VersionVector
 
-        self.logger.debug("delete('%s', %s)", key, dependent_versions)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("delete('%s', %s)", key, dependent_versions)
 
-        self.update_lock.acquire()
+        key_lock = self._key_lock(key)
+        key_lock.acquire()
         try:
             obj_record = self.db.get(key)
             if obj_record is not None:
                 self._local_update(obj_record, key, None, dependent_versions)
         finally:
-            self.update_lock.release()
+            key_lock.release()
 
     def request_sync(self, sync_replica_id):
         """Requests a state sync from the given replica."""
@@ -265,52 +327,48 @@ class Replica:
         # current knowledge
         self.logger.info("Requesting state sync from %s", sync_replica_id)
         self.sync_replica = sync_replica_id
-        self.sync_cookie = random.getrandbits(32)
+        self.next_sync_cookie += 1
+        self.sync_cookie = self.next_sync_cookie ^ self.sync_cookie_salt
         self.sync_replica_visible = None
         self.sync_replica_knowledge = None
         self.sync_in_progress = True
+        self.update_lock.acquire()
+        try:
+            knowledge = self.knowledge.snapshot()
+        finally:
+            self.update_lock.release()
         self.msg_bus.send(self.replica_id, sync_replica_id,
-            SyncRequestMessage(self.sync_cookie, deepcopy(self.knowledge)))
+            SyncRequestMessage(self.sync_cookie, knowledge))
 
     def deliver_message(self, sender_id, msg):
-        if type(msg) is UpdateMessage:
-            self.logger.debug("Processing UpdateMessage from %s", sender_id)
-            self._process_update(sender_id, msg)
-        elif type(msg) is SyncRequestMessage:
-            self.logger.debug("Processing SyncRequestMessage from %s",
-                sender_id)
-            self._process_sync_request(sender_id, msg)
-        elif type(msg) is SyncResponseSetupMessage:
-            self.logger.debug("Processing SyncResponseSetupMessage from %s",
-                sender_id)
-            self._process_sync_response_setup(sender_id, msg)
-        elif type(msg) is SyncResponseDataMessage:
-            self.logger.debug("Processing SyncResponseDataMessage from %s",
-                sender_id)
-            self._process_sync_response_data(sender_id, msg)
-        elif type(msg) is SyncResponseCompleteMessage:
-            self.logger.debug("Processing SyncResponseCompleteMessage from %s",
-                sender_id)
-            self._process_sync_response_complete(sender_id, msg)
-        else:
+        try:
+            handler = self.message_handlers[type(msg)]
+        except KeyError:
             self.logger.warn("Received unknown message type from %s",
                 sender_id)
+            return
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Processing %s from %s", type(msg).__name__,
+                sender_id)
+        handler(sender_id, msg)
 
     def _process_update(self, sender_id, msg):
         assert type(msg) is UpdateMessage
 
-        self.update_lock.acquire()
+        key_lock = self._key_lock(msg.key)
+        key_lock.acquire()
         try:
-            if self.knowledge.has_version(msg.obj_ver.version):
-                # We already have this object
-                return
-
-            obj_record = self.db.get(msg.key)
-            if obj_record is None:
-                obj_record = ObjectRecord()
-            self._insert_object(obj_record, msg.key, msg.obj_ver)
+            obj_record = self.db.get(msg.key, EMPTY_OBJECT_RECORD)
+            self.update_lock.acquire()
+            try:
+                if self.knowledge.has_version(msg.obj_ver.version):
+                    # We already have this object
+                    return
+                self._insert_object(obj_record, msg.key, msg.obj_ver)
+            finally:
+                self.update_lock.release()
         finally:
-            self.update_lock.release()
+            key_lock.release()
 
     def _process_sync_request(self, requestor_id, req_msg):
         assert type(req_msg) is SyncRequestMessage
@@ -321,19 +379,42 @@ class Replica:
         # *** In this simulation we assume that some prefix of these
         # *** messages are delivered in order.
         # We'll use self.committed_visible as our replacement timestamp
+        self.update_lock.acquire()
+        try:
+            knowledge = self.knowledge.snapshot()
+            committed_visible = self._committed_visible_copy()
+        finally:
+            self.update_lock.release()
         self.msg_bus.send(self.replica_id, requestor_id,
-            SyncResponseSetupMessage(cookie,
-            deepcopy(self.knowledge), deepcopy(self.committed_visible)))
-        for k in self.db.iterkeys():
-            obj_record = self.db.get(k)
-            discard_timestamp_for_replacement_vv(obj_record,
-                self.committed_visible)
+            SyncResponseSetupMessage(cookie, knowledge, committed_visible))
+
+        # Most of the versions that the requestor already has will be in the
+        # greatest contiguous prefix of its knowledge, which only needs a
+        # counter comparison. The full version set only needs to be checked
+        # when the requestor's knowledge has gaps.
+        requestor_counter = requestor_knowledge.get_counter
+        requestor_has_gaps = not requestor_knowledge.is_contiguous()
+        # Records are immutable, but other threads may add keys while we
+        # iterate so take a list of the items
+        batch = []
+        for k, obj_record in list(self.db.iteritems()):
+            obj_record = discard_timestamp_for_replacement_vv(obj_record,
+                committed_visible)
 
             for obj_ver in obj_record.versions:
-                if requestor_knowledge.has_version(obj_ver.version):
+                ver = obj_ver.version
+                if ver.counter <= requestor_counter(ver.replica_id):
+                    continue
+                if requestor_has_gaps and requestor_knowledge.has_version(ver):
                     continue
-                self.msg_bus.send(self.replica_id, requestor_id,
-                    SyncResponseDataMessage(cookie, k, obj_ver))
+                batch.append((k, self._outgoing_object_version(obj_ver)))
+                if len(batch) == SYNC_BATCH_SIZE:
+                    self.msg_bus.send(self.replica_id, requestor_id,
+                        SyncResponseDataBatchMessage(cookie, tuple(batch)))
+                    batch = []
+        if batch:
+            self.msg_bus.send(self.replica_id, requestor_id,
+                SyncResponseDataBatchMessage(cookie, tuple(batch)))
         self.msg_bus.send(self.replica_id, requestor_id,
             SyncResponseCompleteMessage(cookie))
 
@@ -346,31 +427,42 @@ class Replica:
         assert type(msg.server_knowledge) is VersionSet
         assert type(msg.server_visible) is VersionVector
         assert msg.server_knowledge.dominates_vv(msg.server_visible)
+        # These are read-only for the rest of the sync
         self.sync_replica_knowledge = msg.server_knowledge
         self.sync_replica_visible = msg.server_visible
 
-    def _process_sync_response_data(self, sender_id, msg):
+    def _process_sync_response_data_batch(self, sender_id, msg):
         if not self.sync_in_progress:
             return
         if sender_id != self.sync_replica or msg.cookie != self.sync_cookie:
             return
-        if self.knowledge.has_version(msg.obj_ver.version):
-            return
 
+        for key, obj_ver in msg.items:
+            self._insert_sync_object_version(key, obj_ver)
+
+    def _insert_sync_object_version(self, key, obj_ver):
         assert type(self.sync_replica_knowledge) is VersionSet
         assert type(self.sync_replica_visible) is VersionVector
 
-        if msg.obj_ver.timestamp is None:
-            msg.obj_ver.timestamp = deepcopy(self.sync_replica_visible)
+        # sync_replica_visible is never modified during the sync and
+        # timestamps are never modified once stored so the object versions
+        # can all share it
+        if obj_ver.timestamp is None:
+            obj_ver = obj_ver.replace_timestamp(self.sync_replica_visible)
 
-        self.update_lock.acquire()
+        key_lock = self._key_lock(key)
+        key_lock.acquire()
         try:
-            obj_record = self.db.get(msg.key)
-            if obj_record is None:
-                obj_record = ObjectRecord()
-            self._insert_object(obj_record, msg.key, msg.obj_ver)
+            obj_record = self.db.get(key, EMPTY_OBJECT_RECORD)
+            self.update_lock.acquire()
+            try:
+                if self.knowledge.has_version(obj_ver.version):
+                    return
+                self._insert_object(obj_record, key, obj_ver)
+            finally:
+                self.update_lock.release()
         finally:
-            self.update_lock.release()
+            key_lock.release()
 
     def _process_sync_response_complete(self, sender_id, msg):
         if not self.sync_in_progress:
@@ -393,20 +485,38 @@ class Replica:
         try:
             self.knowledge.merge(self.sync_replica_knowledge)
             self.visible.update(self.sync_replica_visible)
-            self.committed_visible.update(self.visible)
+            self.knowledge_epoch += 1
+            self.visible_epoch += 1
+            self._commit_visible()
         finally:
             self.update_lock.release()
         self.sync_in_progress = False
         self.sync_replica_knowledge = None
         self.sync_replica_visible = None
 
+    def _key_lock(self, key):
+        """Returns the lock that serializes changes to the given key."""
+        return self.key_locks[hash(key) % KEY_LOCK_STRIPES]
+
     def _filter_visible_versions(self, obj_record):
-        """Returns a list of ObjectVersion objects for the visible versions of
-           the given Object record."""
+        """Returns the versions and values of the visible versions of the
+           given Object record. Update lock must be held.
 
+           The result is cached on the record until self.visible or
+           self.knowledge changes so it must not be modified."""
+
+        assert self.update_lock.locked()
         assert self.knowledge.dominates_vv(self.visible)
         assert self.visible.dominates(self.committed_visible)
 
+        # Latching below may bump the epochs. The cache entry is keyed with
+        # the epochs from before that so the record gets recalculated next
+        # time with the new visible version vector.
+        epochs = (self.visible_epoch, self.knowledge_epoch)
+        if obj_record.visible_cache is not None and \
+                obj_record.visible_cache[0] == epochs:
+            return obj_record.visible_cache[1]
+
         # First, filter out non-visible versions. An object o is visible
         # at replica r if r.visible dominates o.version OR r.knowledge
         # dominates o.timestamp. When the second case is true, we also update
@@ -427,29 +537,40 @@ class Replica:
                 if self.knowledge.dominates_vv(ov.timestamp):
                     # Latch in a swath of versions as visible
                     self.visible.update(ov.timestamp)
+                    self.visible_epoch += 1
                     visible_versions.append(ov)
 
         # Now, of the visible versions, filter out the ones that have
-        # been replaced by newer versions
-        for i in range(len(visible_versions)):
-            if visible_versions[i] is None:
-                continue
-            for j in range(i + 1, len(visible_versions)):
-                if visible_versions[j] is None:
-                    continue
-
+        # been replaced by newer versions. A version has been replaced when
+        # the timestamp of another visible version dominates it. Rather
+        # than comparing every pair of versions, find the two highest
+        # counters for each replica across all of the timestamps. Every
+        # timestamp dominates its own version so each version is compared
+        # against the highest counter that didn't come from its own
+        # timestamp.
+        if len(visible_versions) > 1:
+            highest = {}  # replica_id -> (counter, index of version)
+            second_highest = {}  # replica_id -> counter
+            for i, ov in enumerate(visible_versions):
                 # Timestamps must be present because there are multiple
                 # versions
-                assert visible_versions[i].timestamp is not None
-                assert visible_versions[j].timestamp is not None
-
-                if visible_versions[i].timestamp.dominates_version(
-                        visible_versions[j].version):
-                    visible_versions[j] = None
-                elif visible_versions[j].timestamp.dominates_version(
-                        visible_versions[i].version):
+                assert ov.timestamp is not None
+                for replica_id, c in ov.timestamp.iter_entries():
+                    h = highest.get(replica_id)
+                    if h is None or c > h[0]:
+                        if h is not None:
+                            second_highest[replica_id] = h[0]
+                        highest[replica_id] = (c, i)
+                    elif c > second_highest.get(replica_id, 0):
+                        second_highest[replica_id] = c
+
+            for i, ov in enumerate(visible_versions):
+                replica_id = ov.version.replica_id
+                c, holder = highest.get(replica_id, (0, None))
+                if holder == i:
+                    c = second_highest.get(replica_id, 0)
+                if c >= ov.version.counter:
                     visible_versions[i] = None
-                    break
 
         # Construct our final result
         resulting_values = []
@@ -461,96 +582,174 @@ class Replica:
 
             # There must only be one version for any single replica. Otherwise
             # the replica had somehow conflicted itself.
-            assert resulting_vv.get_version(ov.version.replica_id).counter == 0
+            assert resulting_vv.get_counter(ov.version.replica_id) == 0
             resulting_vv.update_version(ov.version)
-        return (resulting_vv, resulting_values)
+        result = (resulting_vv, resulting_values)
+        obj_record.visible_cache = (epochs, result)
+        return result
 
     def _local_update(self, obj_record, key, value, dependent_versions):
+        """Creates a new local version of an object. The key lock must be
+           held. A dependent_versions of None means the update is a create,
+           which fails if any visible version of the object isn't a
+           tombstone."""
         assert type(obj_record) is ObjectRecord
         assert key is not None
-        assert type(dependent_versions) is VersionVector
-        assert self.update_lock.locked()
-
-        visible_versions = self._filter_visible_versions(obj_record)[0]
-        # If the set of versions is different then the update cannot proceed.
-        # The caller must resolve the conflict and retry. This is due to the
-        # restriction that a replica must create objects that are causally
-        # after all objects that it already knows about. (Due to the
-        # replica-granularity logical clock)
-        if not self.visible.dominates(dependent_versions):
-            raise ValueError("Dependent versions from the future")
-        if visible_versions != dependent_versions:
-            raise ConcurrentUpdateException()
-
-        assert self.knowledge.dominates_vv(self.visible)
-        assert self.knowledge.get_version(self.replica_id) == \
-            self.visible.get_version(self.replica_id)
-        assert self.visible.dominates(self.committed_visible)
-        assert self.visible.get_version(self.replica_id) == \
-            self.committed_visible.get_version(self.replica_id)
+        assert dependent_versions is None or \
+            type(dependent_versions) is VersionVector
+        assert self._key_lock(key).locked()
 
-        ver = self.knowledge.get_version(self.replica_id)
-        ver.counter += 1
-        obj_ver = ObjectVersion(ver, deepcopy(self.visible), value)
-        obj_ver.timestamp.update_version(ver)
+        self.update_lock.acquire()
+        try:
+            if obj_record.versions:
+                visible_versions, visible_values = \
+                    self._filter_visible_versions(obj_record)
+            else:
+                # A new object so there is nothing to filter
+                visible_versions = VersionVector()
+                visible_values = []
+            if dependent_versions is None:
+                # We don't require the caller to explicitly give us the
+                # dependent versions for a create. There really aren't any
+                # dependent versions from the caller's perspective.
+                #
+                # However, if we are internally storing tombstones then those
+                # have to be the dependent versions so the create occurs
+                # causally after the previous deletions. They are found under
+                # the same hold of the update lock as the insert so they
+                # can't change in between.
+                for v in visible_values:
+                    if v is not None:
+                        raise DuplicateKeyException()
+                dependent_versions = visible_versions
+            # If the set of versions is different then the update cannot
+            # proceed. The caller must resolve the conflict and retry. This
+            # is due to the restriction that a replica must create objects
+            # that are causally after all objects that it already knows
+            # about. (Due to the replica-granularity logical clock)
+            if not self.visible.dominates(dependent_versions):
+                raise ValueError("Dependent versions from the future")
+            if visible_versions != dependent_versions:
+                raise ConcurrentUpdateException()
+
+            assert self.knowledge.dominates_vv(self.visible)
+            assert self.knowledge.get_counter(self.replica_id) == \
+                self.visible.get_counter(self.replica_id)
+            assert self.visible.dominates(self.committed_visible)
+            assert self.visible.get_counter(self.replica_id) == \
+                self.committed_visible.get_counter(self.replica_id)
+
+            ver = Version(self.replica_id,
+                self.knowledge.get_counter(self.replica_id) + 1)
+            timestamp = self.visible.snapshot()
+            timestamp.update_version(ver)
+            obj_ver = ObjectVersion(ver, timestamp, value)
+
+            # The new version's timestamp dominates every version that was
+            # visible before, and none of the versions that were not yet
+            # visible can depend on it, so it will be the only visible
+            # version
+            visible_versions = VersionVector()
+            visible_versions.update_version(ver)
+            self._insert_object(obj_record, key, obj_ver, visible_versions)
+            assert self.committed_visible.dominates(obj_ver.timestamp)
+        finally:
+            self.update_lock.release()
 
-        obj_ver_copy = deepcopy(obj_ver)
-        self._insert_object(obj_record, key, obj_ver)
-        assert self.committed_visible.dominates(obj_ver_copy.timestamp)
         self.msg_bus.broadcast(self.replica_id,
-            UpdateMessage(key, obj_ver_copy))
+            UpdateMessage(key, self._outgoing_object_version(obj_ver)))
         return ver
 
-    def _insert_object(self, obj_record, key, obj_ver):
-        """Insert an object and possibly make it visible. Update lock
-           must be held"""
+    def _outgoing_object_version(self, obj_ver):
+        """Returns an object version suitable for sending to other replicas.
+           The version and timestamp are never modified so they can be
+           shared but the value belongs to the application so it is copied.
+           A message bus that serializes messages, or that only connects
+           replicas which never modify values, can set needs_copy to False
+           to skip the copy."""
+        if not getattr(self.msg_bus, 'needs_copy', True):
+            return obj_ver
+        return ObjectVersion(obj_ver.version, obj_ver.timestamp,
+                             deepcopy(obj_ver.value))
+
+    def _insert_object(self, obj_record, key, obj_ver,
+                       visible_versions=None):
+        """Insert an object and possibly make it visible. The key lock
+           and the update lock must be held.
+
+           If the caller already knows which versions of the object will
+           be visible after the insert it can pass them in visible_versions
+           so they don't need to be recalculated."""
         assert type(obj_record) is ObjectRecord
         assert key is not None
         assert type(obj_ver) is ObjectVersion
         assert not self.knowledge.has_version(obj_ver.version)
         assert obj_ver.timestamp is not None
+        assert self._key_lock(key).locked()
         assert self.update_lock.locked()
 
-        self.logger.debug("Inserting object '%s' version %s, timestamp=%s",
-            key, obj_ver.version, obj_ver.timestamp)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(
+                "Inserting object '%s' version %s, timestamp=%s",
+                key, obj_ver.version, obj_ver.timestamp)
 
         # Reconstruct the timestamps for existing versions while we
-        # integrate the new object version
+        # integrate the new object version. The stored record is left
+        # untouched; a new one is built and swapped in at the end.
+        versions = []
         for ov in obj_record.versions:
             if ov.timestamp is None:
                 # It is safe to replace the timestamp with committed_visible
                 # because committed_visible satisfies all the constraints
                 # for a timestamp that has been discarded
-                ov.timestamp = deepcopy(self.committed_visible)
+                ov = ov.replace_timestamp(self._committed_visible_copy())
+            versions.append(ov)
 
-        obj_record.versions.append(obj_ver)
+        versions.append(obj_ver)
         self.knowledge.insert_version(obj_ver.version)
+        self.knowledge_epoch += 1
         if self.knowledge.dominates_vv(obj_ver.timestamp):
             self.visible.update(obj_ver.timestamp)
+            self.visible_epoch += 1
 
-        # TODO recalculate visible_versions more efficiently
-        visible_versions = self._filter_visible_versions(obj_record)[0]
+        if visible_versions is None:
+            visible_versions = self._filter_visible_versions(
+                ObjectRecord(tuple(versions)))[0]
 
         # Filter out versions no longer needed. A version needs to be
         # retained when:
         #  * It is visible; OR
         #  * It has not yet been made visible
-        for i in range(len(obj_record.versions) - 1, -1, -1):
-            obj_ver = obj_record.versions[i]
-            if obj_ver.version == visible_versions.get_version(
-                    obj_ver.version.replica_id):
+        visible_set = frozenset(visible_versions.iter_entries())
+
+        def needed(ov):
+            if (ov.version.replica_id, ov.version.counter) in visible_set:
                 # Object version is visible. Keep it!
-                continue
-            if not self.visible.dominates_version(obj_ver.version):
-                # Object version has not yet been made visible
-                continue
-            del obj_record.versions[i]
-        assert len(obj_record.versions) > 0
+                return True
+            return not self.visible.dominates_version(ov.version)
+
+        versions = tuple(ov for ov in versions if needed(ov))
+        assert len(versions) > 0
 
-        discard_timestamp_for_replacement_vv(obj_record, self.visible)
+        obj_record = discard_timestamp_for_replacement_vv(
+            ObjectRecord(versions), self.visible)
 
         self.db.put(key, obj_record)
-        self.committed_visible.update(self.visible)
+        self._commit_visible()
+
+    def _committed_visible_copy(self):
+        """Returns a copy of committed_visible which must not be modified.
+           Update lock must be held."""
+        if self.committed_visible_copy is None:
+            self.committed_visible_copy = self.committed_visible.snapshot()
+        return self.committed_visible_copy
+
+    def _commit_visible(self):
+        """Merges visible into committed_visible. Update lock must be
+           held."""
+        if not self.committed_visible.dominates(self.visible):
+            self.committed_visible.update(self.visible)
+            self.committed_visible_copy = None
 
 
 # We can discard timestamps, making it eligible to be replaced by 'vv' or
@@ -565,13 +764,19 @@ class Replica:
 #   4. We assume the local 'knowledge' dominates vv (ensured by the caller).
 #      When check #1 also succeeds we can also infer that the local
 #      'knowledge' dominates the timestamp
+#
+# Returns the record with the timestamp discarded, which is a new record if
+# anything had to be changed.
 def discard_timestamp_for_replacement_vv(obj_record, vv):
     assert isinstance(obj_record, ObjectRecord)
     assert isinstance(vv, VersionVector)
 
-    if len(obj_record.versions) == 1 and \
-            vv.dominates_version(obj_record.versions[0].version):
-        obj_record.versions[0].timestamp = None
+    if len(obj_record.versions) == 1:
+        obj_ver = obj_record.versions[0]
+        if obj_ver.timestamp is not None and \
+                vv.dominates_version(obj_ver.version):
+            return ObjectRecord((obj_ver.replace_timestamp(None),))
+    return obj_record
 
 
 # vim:set ts=4 sw=4 expandtab:
@@ -1,7 +1,20 @@
+from array import array
+from bisect import bisect_left, bisect_right
+
+
 __all__ = ['Version', 'VersionVector', 'VersionSet']
 
+# The number of versions past the greatest contiguous prefix of a replica
+# that a VersionSet tracks in a bitmap. Versions further out are kept in a
+# sorted array instead.
+EXTRAS_BITMAP_BITS = 1024
+
 
 class Version:
+    """A single version created by a replica. Versions are hashable so they
+       must not be modified after they have been created."""
+    __slots__ = ('replica_id', 'counter')
+
     def __init__(self, replica_id=None, counter=0):
         self.replica_id = replica_id
         self.counter = counter
@@ -10,6 +23,9 @@ class Version:
         return (self.replica_id == other.replica_id) and \
             (self.counter == other.counter)
 
+    def __hash__(self):
+        return hash((self.replica_id, self.counter))
+
     def __str__(self):
         return "{}:{}".format(self.replica_id, self.counter)
 
@@ -18,6 +34,8 @@ class Version:
 
 
 class VersionVector:
+    __slots__ = ('v',)
+
     def __init__(self):
         # Map of replica ID to version counter. Replicas with no value in this
         # map have a version counter of 0.
@@ -29,7 +47,7 @@ class VersionVector:
     def empty(self):
         """Returns a boolean value indicating if the version vector has
            no versions greater than 0."""
-        return len(self.v) == 0
+        return not self.v
 
     def dominates(self, other):
         """Checks if this version vector dominates another.
@@ -37,17 +55,15 @@ class VersionVector:
            A version vector (X) dominates another version vector (Y)
            when all versions in X are greater than or equal to all
            versions in Y."""
-        assert isinstance(other, VersionVector)
-
-        ids = set(self.v.keys()).union(set(other.v.keys()))
-        for id in ids:
-            lc = 0
-            rc = 0
-            if id in self.v:
-                lc = self.v[id]
-            if id in other.v:
-                rc = other.v[id]
-            if lc < rc:
+        # Versions in this vector for replicas missing from the other
+        # vector can't be less than the other's implicit 0 so only the
+        # other vector's entries need to be checked.
+        ov = other.v
+        if not ov:
+            return True
+        sv = self.v
+        for replica_id, rc in ov.items():
+            if sv.get(replica_id, 0) < rc:
                 return False
         return True
 
@@ -57,121 +73,241 @@ class VersionVector:
            A version vector (X) dominates a version (Y) when the
            version in X for the replica associated with Y is greater
            than or equal to Y."""
-        assert isinstance(ver, Version)
-
-        if ver.replica_id in self.v:
-            c = self.v[ver.replica_id]
-        else:
-            c = 0
-        return c >= ver.counter
+        return self.v.get(ver.replica_id, 0) >= ver.counter
 
     def update(self, other):
         """Merges another version vector into this one. The resulting
            version vector will contain the maximum versions from both."""
-        assert isinstance(other, VersionVector)
-
+        sv = self.v
         for replica_id, c in other.v.items():
-            self.update_version(Version(replica_id, c))
+            if c > sv.get(replica_id, 0):
+                sv[replica_id] = c
 
     def update_version(self, ver):
         """Merges one version into the version vector, updating the
            highest version for the given replica"""
-        assert isinstance(ver, Version)
-
-        if ver.replica_id not in self.v:
-            self.v[ver.replica_id] = ver.counter
-        else:
-            self.v[ver.replica_id] = max(self.v[ver.replica_id], ver.counter)
+        c = ver.counter
+        if c > self.v.get(ver.replica_id, 0):
+            self.v[ver.replica_id] = c
 
     def get_version(self, replica_id):
         """Gets the value of a single replica version from the version
            vector."""
-        try:
-            c = self.v[replica_id]
-            return Version(replica_id, c)
-        except KeyError:
-            return Version(replica_id, 0)
+        return Version(replica_id, self.v.get(replica_id, 0))
+
+    def get_counter(self, replica_id):
+        """Gets the counter of a single replica version from the version
+           vector."""
+        return self.v.get(replica_id, 0)
 
     def inc_version(self, replica_id):
         """Increments the value of a single replica verion in the
            version vector."""
-        try:
-            self.v[replica_id] += 1
-        except KeyError:
-            self.v[replica_id] = 1
-        return Version(replica_id, self.v[replica_id])
+        c = self.v.get(replica_id, 0) + 1
+        self.v[replica_id] = c
+        return Version(replica_id, c)
 
-    def __str__(self):
-        node_ids = self.v.keys()
-        result = "[ "
-        for nId in sorted(node_ids):
-            result += str(Version(nId, self.v[nId]))
-            result += " "
-        result += "]"
+    def iter_entries(self):
+        """Returns an iterator of (replica_id, counter) tuples for the
+           replicas with a version greater than 0."""
+        return iter(self.v.items())
+
+    def snapshot(self):
+        """Returns an independent copy of this version vector."""
+        result = VersionVector()
+        result.v = self.v.copy()
         return result
 
+    def freeze(self):
+        """Returns a hashable snapshot of this version vector. Equal version
+           vectors return equal results so it can be used as a dict key."""
+        return tuple(sorted(self.v.items()))
+
+    def __str__(self):
+        v = self.v
+        return "[ " + "".join(["{}:{} ".format(nId, v[nId])
+                               for nId in sorted(v)]) + "]"
+
 
 class VersionSetElement:
+    __slots__ = ('prefix_max', 'extras', 'far_extras')
+
     def __init__(self):
         # A range [ 0 - prefix_max ] of contiguous versions
         self.prefix_max = 0
-        # A set of non-contiguous versions > prefix_max
-        self.extras = set()
+        # A bitmap of the non-contiguous versions just past the prefix.
+        # Bit N is set when version prefix_max + 1 + N is in the set. Bit 0
+        # is always clear because that version would extend the prefix.
+        # Only the first EXTRAS_BITMAP_BITS versions past the prefix are
+        # kept here so the bitmap stays small.
+        self.extras = 0
+        # None or a sorted array of the non-contiguous versions past the
+        # bitmap, for replicas missing a long run of versions
+        self.far_extras = None
+
+    def has_extras(self):
+        """Returns a boolean value indicating if there are any versions
+           past the prefix."""
+        return bool(self.extras or self.far_extras)
+
+    def contains(self, version):
+        offset = version - self.prefix_max - 1
+        if offset < 0:
+            return True
+        if offset < EXTRAS_BITMAP_BITS:
+            return (self.extras >> offset) & 1 == 1
+        far = self.far_extras
+        if far is None:
+            return False
+        i = bisect_left(far, version)
+        return i < len(far) and far[i] == version
+
+    def iter_extras(self):
+        """Returns an iterator over the non-contiguous versions in
+           ascending order."""
+        prefix_max = self.prefix_max
+        bits = self.extras
+        while bits:
+            lowest = bits & -bits
+            yield prefix_max + lowest.bit_length()
+            bits ^= lowest
+        if self.far_extras is not None:
+            for version in self.far_extras:
+                yield version
 
     def insert(self, version):
-        if version <= self.prefix_max:
+        offset = version - self.prefix_max - 1
+        if offset < 0:
             return
-        if version == self.prefix_max + 1:
-            self.prefix_max = version
-            # Remove extras no longer necessary
-            self.extras.discard(version)
-            self._merge_extras()
+        if offset < EXTRAS_BITMAP_BITS:
+            self.extras |= 1 << offset
+            if offset == 0:
+                self._merge_extras()
+            return
+        far = self.far_extras
+        if far is None:
+            self.far_extras = array('q', (version,))
         else:
-            self.extras.add(version)
+            i = bisect_left(far, version)
+            if i == len(far) or far[i] != version:
+                far.insert(i, version)
+
+    def insert_many(self, versions):
+        """Inserts several versions, in any order, merging the extras into
+           the prefix only once."""
+        prefix_max = self.prefix_max
+        bits = self.extras
+        far = []
+        for version in versions:
+            offset = version - prefix_max - 1
+            if offset >= EXTRAS_BITMAP_BITS:
+                far.append(version)
+            elif offset >= 0:
+                bits |= 1 << offset
+        self.extras = bits
+        if far:
+            self._insert_far_extras(far)
+        self._merge_extras()
 
     def update_prefix_upper_bound(self, version):
         if version > self.prefix_max:
-            self.prefix_max = version
             # Remove extra versions no longer necessary
-            self.extras = set(
-                filter(lambda x: x > self.prefix_max, self.extras))
+            self.extras >>= version - self.prefix_max
+            self.prefix_max = version
             self._merge_extras()
 
-    def insert_extras(self, extras):
-        """Add the given extras to this tuple's extra set."""
-        self.extras.update(extras)
-        # Remove extra versions no longer necessary
-        self.extras = set(filter(lambda x: x > self.prefix_max, self.extras))
+    def merge(self, other):
+        """Merges all of the versions in another element into this one."""
+        self.update_prefix_upper_bound(other.prefix_max)
+        # Line the other bitmap up with this one, dropping the versions
+        # this prefix already covers, and combine them
+        self.extras |= other.extras >> (self.prefix_max - other.prefix_max)
+        if other.far_extras is not None:
+            self._insert_far_extras(other.far_extras)
         self._merge_extras()
 
+    def copy(self):
+        result = VersionSetElement()
+        result.prefix_max = self.prefix_max
+        result.extras = self.extras
+        if self.far_extras is not None:
+            result.far_extras = array('q', self.far_extras)
+        return result
+
+    def _insert_far_extras(self, versions):
+        # The versions are moved into the bitmap by _merge_extras if they
+        # are close enough to the prefix
+        merged = set(versions)
+        if self.far_extras is not None:
+            merged.update(self.far_extras)
+        self.far_extras = array('q', sorted(merged))
+
     def _merge_extras(self):
-        while self.prefix_max + 1 in self.extras:
-            self.extras.remove(self.prefix_max + 1)
-            self.prefix_max += 1
+        while True:
+            # Count the run of set bits at the bottom of the bitmap. Those
+            # versions extend the prefix.
+            n = (~self.extras & (self.extras + 1)).bit_length() - 1
+            if n > 0:
+                self.prefix_max += n
+                self.extras >>= n
+
+            # Move the far versions that are now within reach of the
+            # bitmap into it, which may extend the prefix again
+            far = self.far_extras
+            if far is None:
+                return
+            limit = self.prefix_max + EXTRAS_BITMAP_BITS
+            if far[0] > limit:
+                return
+            i = bisect_right(far, limit)
+            base = self.prefix_max + 1
+            for version in far[:i]:
+                if version >= base:
+                    self.extras |= 1 << (version - base)
+            del far[:i]
+            if not far:
+                self.far_extras = None
 
 
 class VersionSet:
+    __slots__ = ('v',)
+
     def __init__(self, iterable=None):
         # Map of replica ID to version set. Replicas with no value in this
         # map have no versions.
         self.v = {}
 
         if iterable is not None:
+            # Group the counters by replica so each element is loaded in a
+            # single pass
+            counters = {}
             for ver in iterable:
-                self.insert_version(ver)
+                counters.setdefault(ver.replica_id, []).append(ver.counter)
+            for replica_id, c in counters.items():
+                self._get_element(replica_id).insert_many(c)
 
     def empty(self):
         """Returns a boolean value indicating if the set is empty."""
-        return len(self.v) == 0
+        return not self.v
+
+    def is_contiguous(self):
+        """Returns a boolean value indicating if all of the versions in the
+           set are in its greatest contiguous prefix."""
+        for e in self.v.values():
+            if e.has_extras():
+                return False
+        return True
 
     def get_version(self, replica_id):
         """Gets the version for a single replica in the greatest contiguous
            prefix."""
-        try:
-            c = self.v[replica_id].prefix_max
-            return Version(replica_id, c)
-        except KeyError:
-            return Version(replica_id, 0)
+        return Version(replica_id, self.get_counter(replica_id))
+
+    def get_counter(self, replica_id):
+        """Gets the counter for a single replica in the greatest contiguous
+           prefix."""
+        e = self.v.get(replica_id)
+        return 0 if e is None else e.prefix_max
 
     def get_gcp(self):
         """Returns the greatest contiguous prefix of this set of versions.
@@ -191,59 +327,56 @@ class VersionSet:
 
            A version set (X) dominates a version vector (Y) when the
            greatest contiguous prefix of X dominates Y."""
-        assert isinstance(vv, VersionVector)
-        return self.get_gcp().dominates(vv)
+        # Compare against the prefixes directly rather than building the
+        # greatest contiguous prefix, which is invalidated whenever the
+        # set changes.
+        sv = self.v
+        for replica_id, c in vv.v.items():
+            e = sv.get(replica_id)
+            if c > (0 if e is None else e.prefix_max):
+                return False
+        return True
 
     def has_version(self, ver):
         """Determines if the given version is contained in this version set."""
-        assert isinstance(ver, Version)
-
         try:
             e = self.v[ver.replica_id]
         except KeyError:
             return (ver.counter == 0)
-        if ver.counter <= e.prefix_max:
-            return True
-        if ver.counter in e.extras:
-            return True
-        return False
+        return e.contains(ver.counter)
 
     def insert_version(self, ver):
         """Inserts a single version into the version set."""
-        assert isinstance(ver, Version)
-
         self._get_element(ver.replica_id).insert(ver.counter)
 
     def merge(self, other):
         """Merges another VersionSet into this one so that this set contains
            the union of all versions in both."""
-        assert isinstance(other, VersionSet)
-
         for replica_id, oe in other.v.items():
-            e = self._get_element(replica_id)
-            e.update_prefix_upper_bound(oe.prefix_max)
-            e.insert_extras(oe.extras)
+            self._get_element(replica_id).merge(oe)
 
     def merge_one_version(self, ver):
         """Merges one version into the version set, including all of the
            versions with the same replica ID prior to it."""
-        assert isinstance(ver, Version)
+        self._get_element(ver.replica_id).update_prefix_upper_bound(
+            ver.counter)
 
-        self._get_element(ver.replica_id) \
-            .update_prefix_upper_bound(ver.counter)
+    def snapshot(self):
+        """Returns an independent copy of this version set."""
+        result = VersionSet()
+        for replica_id, e in self.v.items():
+            result.v[replica_id] = e.copy()
+        return result
 
     def __str__(self):
-        node_ids = self.v.keys()
-        node_ids.sort()
-        result = "[ "
-        for nId in node_ids:
+        parts = []
+        for nId in sorted(self.v):
             n = self.v[nId]
-            result += str(Version(nId, n.prefix_max))
-            if len(n.extras) > 0:
-                result += "+[%s]" % ",".join([str(i) for i in n.extras])
-            result += " "
-        result += "]"
-        return result
+            parts.append("{}:{}".format(nId, n.prefix_max))
+            if n.has_extras():
+                parts.append("+[%s]" % ",".join(map(str, n.iter_extras())))
+            parts.append(" ")
+        return "[ " + "".join(parts) + "]"
 
     def _get_element(self, replica_id):
         try:
@@ -1,9 +1,11 @@
+import threading
+from collections import deque
 from copy import deepcopy
 
 import pytest
 
 from cvv.replica import ConcurrentUpdateException, DuplicateKeyException, \
-    NoSuchKeyException, Replica
+    NoSuchKeyException, Replica, SYNC_BATCH_SIZE
 from cvv.vtypes import Version, VersionVector
 
 
@@ -12,14 +14,20 @@ class FakeMessageBus:
         self.members = {}
 
     def add_member(self, member_id, member):
-        self.members[member_id] = (member, [])
+        self.members[member_id] = (member, deque())
 
     def broadcast(self, sender_id, msg):
         """Enqueues a message to all members except the sender."""
         for member_id, v in self.members.items():
             member, q = v[0:2]
             if member_id != sender_id:
-                v[1].append((sender_id, deepcopy(msg)))
+                # Messages are immutable but the values they carry are not,
+                # so each member gets its own copy unless the values are
+                # never modified
+                if getattr(self, 'needs_copy', True):
+                    v[1].append((sender_id, deepcopy(msg)))
+                else:
+                    v[1].append((sender_id, msg))
 
     def send(self, sender_id, dest_id, msg):
         """Enqueues a message to the given recipient."""
@@ -36,24 +44,31 @@ class FakeMessageBus:
     def drop_all_messages(self):
         for v in self.members.values():
             q = v[1]
-            del q[:]
+            q.clear()
 
     def deliver_one(self, member_id):
         member, q = self.members[member_id][0:2]
-        sender_id, msg = q.pop(0)
+        sender_id, msg = q.popleft()
         member.deliver_message(sender_id, msg)
 
     def deliver_all(self):
-        for v in self.members.values():
-            member, q = v[0:2]
-            while len(q) > 0:
-                sender_id, msg = q.pop(0)
-                member.deliver_message(sender_id, msg)
+        for member, q in self.members.values():
+            deliver = member.deliver_message
+            popleft = q.popleft
+            while q:
+                sender_id, msg = popleft()
+                deliver(sender_id, msg)
+
+
+class SharingMessageBus(FakeMessageBus):
+    # Values in most of the tests are never modified so the replicas don't
+    # need to copy them
+    needs_copy = False
 
 
 @pytest.fixture
 def msg_bus():
-    return FakeMessageBus()
+    return SharingMessageBus()
 
 
 @pytest.fixture
@@ -127,6 +142,56 @@ def test_create_conflict(msg_bus, r1, r2, r3):
         assert sorted(rres.values) == ['chicago', 'munich']
 
 
+def test_create_many_way_conflict(msg_bus):
+    replicas = []
+    for i in range(12):
+        replica = Replica('R%02d' % i, msg_bus)
+        msg_bus.add_member(replica.replica_id, replica)
+        replicas.append(replica)
+
+    # Every replica creates the object concurrently
+    for replica in replicas:
+        replica.create('place', 'city%s' % replica.replica_id)
+    msg_bus.deliver_all()
+
+    expected = sorted('city%s' % r.replica_id for r in replicas)
+    for replica in replicas:
+        assert sorted(replica.read('place').values) == expected
+
+    # Resolving the conflict on one replica replaces all of the versions
+    rv = replicas[0].read('place')
+    replicas[0].update('place', 'resolved', rv.dependent_versions)
+    msg_bus.deliver_all()
+    for replica in replicas:
+        assert replica.read('place').values == ['resolved']
+
+
+def test_create_from_many_threads(msg_bus, r1, r2):
+    def create_keys(prefix):
+        for i in range(50):
+            r1.create('%s.%d' % (prefix, i), i)
+
+    threads = [threading.Thread(target=create_keys, args=('t%d' % n,))
+               for n in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    msg_bus.deliver_all()
+
+    # Every create must have been given its own version
+    versions = set()
+    for n in range(4):
+        for i in range(50):
+            key = 't%d.%d' % (n, i)
+            for replica in (r1, r2):
+                assert replica.read(key).values == [i]
+            rv = r1.read(key)
+            versions.add(rv.dependent_versions.get_version(r1.replica_id)
+                         .counter)
+    assert versions == set(range(1, 201))
+
+
 def test_create_disallow_known_conflict(msg_bus, r1, r2, r3):
     # Create object on r1 and replicate
     r1.create('place', 'philadelphia')
@@ -161,6 +226,58 @@ def test_create_many(msg_bus, r1, r2, r3):
         assert replica.read('jim.food').values == ['steak']
 
 
+def test_read_returns_copies(msg_bus, r1):
+    r1.create('key1', 'value1')
+
+    rv = r1.read('key1')
+    rv.dependent_versions.inc_version(r1.replica_id)
+    rv.values.append('value2')
+
+    rv = r1.read('key1')
+    assert rv.dependent_versions.get_version(r1.replica_id) == \
+        Version(r1.replica_id, 1)
+    assert rv.values == ['value1']
+
+
+def test_read_nonexistant_results_are_independent(r1):
+    rv1 = r1.read('fakekey')
+    rv2 = r1.read('fakekey')
+    rv1.values.append('value1')
+    rv1.dependent_versions.inc_version(r1.replica_id)
+
+    assert rv2.values == []
+    assert rv2.dependent_versions == VersionVector()
+
+
+def test_values_are_copied_between_replicas():
+    # By default a replica copies the values it sends
+    msg_bus = FakeMessageBus()
+    r1 = Replica('AA', msg_bus)
+    msg_bus.add_member(r1.replica_id, r1)
+    r2 = Replica('BB', msg_bus)
+    msg_bus.add_member(r2.replica_id, r2)
+
+    value = ['london']
+    r1.create('location', value)
+    msg_bus.deliver_all()
+
+    # r3 joins late so it only gets the value through a sync
+    r3 = Replica('CC', msg_bus)
+    msg_bus.add_member(r3.replica_id, r3)
+    r3.request_sync(r1.replica_id)
+    msg_bus.deliver_all()  # Deliver request
+    msg_bus.deliver_all()  # Deliver responses
+
+    value.append('paris')
+    assert r1.read('location').values == [['london', 'paris']]
+    assert r2.read('location').values == [['london']]
+    assert r3.read('location').values == [['london']]
+
+    r2.read('location').values[0].append('tokyo')
+    assert r1.read('location').values == [['london', 'paris']]
+    assert r3.read('location').values == [['london']]
+
+
 def test_update_known_nonexistant(r1):
     with pytest.raises(NoSuchKeyException):
         r1.update('fakekey', 'the_value', VersionVector())
@@ -289,6 +406,57 @@ def test_create_after_delete(msg_bus, r1, r2):
         # TODO: validate rres.dependent_versions
 
 
+class ReleaseHookLock:
+    """Wraps a lock to run a function the next time it is released."""
+
+    def __init__(self, lock):
+        self.lock = lock
+        self.on_release = None
+
+    def acquire(self):
+        self.lock.acquire()
+
+    def release(self):
+        self.lock.release()
+        on_release, self.on_release = self.on_release, None
+        if on_release is not None:
+            on_release()
+
+    def locked(self):
+        return self.lock.locked()
+
+
+def test_create_after_delete_with_concurrent_delivery(msg_bus, r1, r2):
+    r1.create('key1', 'value1')
+    msg_bus.deliver_all()
+    r1.delete('key1', r1.read('key1').dependent_versions)
+    msg_bus.deliver_all()
+
+    # r2 recreates and deletes key1 after creating another object, so its
+    # new tombstone can't be visible on r1 until the other object arrives
+    other_key = next(k for k in ('key2', 'key3', 'key4', 'key5')
+                     if r1._key_lock(k) is not r1._key_lock('key1'))
+    r2.create(other_key, 'value2')
+    r2.create('key1', 'value3')
+    r2.delete('key1', r2.read('key1').dependent_versions)
+    msg_bus.reorder(r1.replica_id)
+    msg_bus.deliver_one(r1.replica_id)
+    msg_bus.deliver_one(r1.replica_id)
+    assert r1.read('key1').values == []
+
+    # Deliver the other object while the create is in progress. The
+    # create must not see the set of tombstones change underneath it.
+    r1.update_lock = ReleaseHookLock(r1.update_lock)
+    r1.update_lock.on_release = lambda: msg_bus.deliver_one(r1.replica_id)
+    r1.create('key1', 'new_value')
+    assert r1.read(other_key).values == ['value2']
+
+    # The create is concurrent with r2's tombstone
+    msg_bus.deliver_all()
+    for replica in (r1, r2):
+        assert 'new_value' in replica.read('key1').values
+
+
 def test_deliver_out_of_order(msg_bus, r1, r2, r3):
     r1.create('key1.1', 'aaa')
     r1.create('key2.1', 'bbb')
@@ -401,6 +569,22 @@ def test_sync_conflict(msg_bus, r1, r2, r3):
     assert sorted(rv.values) == ['cambridge', 'london']
 
 
+def test_sync_many_objects(msg_bus, r1, r2):
+    num_objects = SYNC_BATCH_SIZE * 2 + 1
+    for i in range(num_objects):
+        r1.create('key%d' % i, i)
+    msg_bus.drop_all_messages()
+
+    r2.request_sync(r1.replica_id)
+    msg_bus.deliver_one(r1.replica_id)  # Deliver request
+
+    # Setup, 3 batches of data and completion
+    assert len(msg_bus.members[r2.replica_id][1]) == 5
+    msg_bus.deliver_all()  # Deliver responses
+    for i in range(num_objects):
+        assert r2.read('key%d' % i).values == [i]
+
+
 def test_sync_with_version_gaps(msg_bus, r1, r2, r3):
     # Separate the final object versions by 5
     r1.create('meal', 'chicken piccata')
@@ -417,7 +601,7 @@ def test_sync_with_version_gaps(msg_bus, r1, r2, r3):
     # r3 requests a sync from r1
     r3.request_sync(r1.replica_id)
     msg_bus.deliver_one(r1.replica_id)  # Deliver request
-    for _ in range(4):  # Deliver sync responses except the completion msg
+    for _ in range(2):  # Deliver sync responses except the completion msg
         msg_bus.deliver_one(r3.replica_id)
 
     # Nothing should be visible yet
@@ -26,6 +26,12 @@ def test_comparison():
     assert r2_1 == r2_1p
 
 
+def test_hash():
+    assert hash(Version('AA', 1)) == hash(Version('AA', 1))
+    assert len({Version('AA', 1), Version('AA', 1), Version('AA', 2),
+                Version('BB', 1)}) == 3
+
+
 def test_str():
     assert str(Version()) == 'None:0'
     assert str(Version('AA', 3)) == 'AA:3'
@@ -1,4 +1,9 @@
-from cvv.vtypes import Version, VersionSet, VersionVector
+import random
+
+import pytest
+
+from cvv import vtypes
+from cvv.vtypes import EXTRAS_BITMAP_BITS, Version, VersionSet, VersionVector
 
 
 def test_empty():
@@ -9,6 +14,33 @@ def test_empty():
     assert not vs.empty()
 
 
+def test_is_contiguous():
+    vs = VersionSet()
+    assert vs.is_contiguous()
+
+    vs.insert_version(Version('AA', 1))
+    vs.insert_version(Version('BB', 1))
+    vs.insert_version(Version('BB', 2))
+    assert vs.is_contiguous()
+
+    vs.insert_version(Version('AA', 3))
+    assert not vs.is_contiguous()
+
+    vs.insert_version(Version('AA', 2))
+    assert vs.is_contiguous()
+
+
+def test_init_from_unordered_versions():
+    vs = VersionSet([Version('AA', 3), Version('BB', 2), Version('AA', 1),
+                     Version('AA', 5), Version('AA', 2), Version('AA', 3)])
+    assert vs.get_version('AA') == Version('AA', 3)
+    assert vs.get_version('BB') == Version('BB', 0)
+    assert vs.has_version(Version('AA', 5))
+    assert not vs.has_version(Version('AA', 4))
+    assert vs.has_version(Version('BB', 2))
+    assert not vs.has_version(Version('BB', 1))
+
+
 def test_has_version():
     vs = VersionSet([Version('AA', 1), Version('AA', 3), Version('BB', 4)])
 
@@ -69,6 +101,9 @@ def test_get_gcp_get_version():
     assert vs.get_version('AA') == expected_gcp.get_version('AA')
     assert vs.get_version('BB') == expected_gcp.get_version('BB')
     assert vs.get_version('CC') == expected_gcp.get_version('CC')
+    assert vs.get_counter('AA') == 4
+    assert vs.get_counter('CC') == 0
+    assert vs.get_counter('DD') == 0
 
 
 def test_merge_one_version():
@@ -93,4 +128,153 @@ def test_merge_one_version():
     assert vs.get_gcp() == expected_gcp
 
 
+def test_merge_with_extras():
+    vs = VersionSet([Version('AA', 1), Version('AA', 3), Version('AA', 70)])
+    other = VersionSet()
+    other.merge_one_version(Version('AA', 2))
+    other.insert_version(Version('AA', 4))
+    other.insert_version(Version('AA', 5))
+    other.insert_version(Version('AA', 69))
+    other.insert_version(Version('AA', 100))
+    vs.merge(other)
+    assert vs.get_version('AA') == Version('AA', 5)
+    for c in range(1, 6):
+        assert vs.has_version(Version('AA', c))
+    for c in (6, 68, 71, 99, 101):
+        assert not vs.has_version(Version('AA', c))
+    for c in (69, 70, 100):
+        assert vs.has_version(Version('AA', c))
+
+    # Merging a set that's behind this one only adds its extras
+    vs.merge(VersionSet([Version('AA', 1), Version('AA', 99)]))
+    assert vs.get_version('AA') == Version('AA', 5)
+    assert vs.has_version(Version('AA', 99))
+
+
+def test_get_gcp_after_changes():
+    vs = VersionSet()
+    expected_gcp = VersionVector()
+    assert vs.get_gcp() == expected_gcp
+
+    vs.insert_version(Version('AA', 2))
+    assert vs.get_gcp() == expected_gcp
+    vs.insert_version(Version('AA', 1))
+    expected_gcp.update_version(Version('AA', 2))
+    assert vs.get_gcp() == expected_gcp
+
+    vs.merge_one_version(Version('BB', 3))
+    expected_gcp.update_version(Version('BB', 3))
+    assert vs.get_gcp() == expected_gcp
+
+    vs.merge(VersionSet([Version('AA', 3), Version('CC', 1)]))
+    expected_gcp.update_version(Version('AA', 3))
+    expected_gcp.update_version(Version('CC', 1))
+    assert vs.get_gcp() == expected_gcp
+    assert vs.dominates_vv(expected_gcp)
+
+    # Changing the result doesn't change the set
+    vs.get_gcp().update_version(Version('BB', 5))
+    assert vs.get_gcp() == expected_gcp
+    assert not vs.has_version(Version('BB', 5))
+
+
+def test_large_gap():
+    # A replica that is missing most of another's history and then gets
+    # its live updates must not track the whole gap in the bitmap
+    vs = VersionSet([Version('AA', 1)])
+    base = 10 ** 7
+    for c in range(base, base + 2000):
+        assert not vs.has_version(Version('AA', c))
+        vs.insert_version(Version('AA', c))
+        assert vs.has_version(Version('AA', c))
+    e = vs.v['AA']
+    assert e.extras.bit_length() <= EXTRAS_BITMAP_BITS
+    assert vs.get_version('AA') == Version('AA', 1)
+    assert not vs.has_version(Version('AA', base - 1))
+    assert not vs.is_contiguous()
+
+    # Filling in the history brings the far versions into the prefix
+    vs.merge_one_version(Version('AA', base - 10))
+    assert vs.get_version('AA') == Version('AA', base - 10)
+    vs.merge(VersionSet([Version('AA', c) for c in range(base - 9, base)]))
+    assert vs.get_version('AA') == Version('AA', base + 1999)
+    assert vs.is_contiguous()
+    assert e.far_extras is None
+
+
+def test_dominates_vv():
+    vs = VersionSet([Version('AA', 1), Version('AA', 2), Version('AA', 4),
+                     Version('BB', 1)])
+    vv = VersionVector()
+    assert vs.dominates_vv(vv)
+    vv.update_version(Version('AA', 2))
+    assert vs.dominates_vv(vv)
+    vv.update_version(Version('BB', 1))
+    assert vs.dominates_vv(vv)
+    vv.update_version(Version('CC', 1))
+    assert not vs.dominates_vv(vv)
+
+    # Extra versions past a gap aren't part of the prefix
+    vv = VersionVector()
+    vv.update_version(Version('AA', 4))
+    assert not vs.dominates_vv(vv)
+    vs.insert_version(Version('AA', 3))
+    assert vs.dominates_vv(vv)
+
+
+@pytest.mark.parametrize('bitmap_bits', [EXTRAS_BITMAP_BITS, 4])
+def test_matches_set_of_versions(monkeypatch, bitmap_bits):
+    # A small bitmap moves most of the extras through the far array
+    monkeypatch.setattr(vtypes, 'EXTRAS_BITMAP_BITS', bitmap_bits)
+    rng = random.Random(1234)
+    for _ in range(50):
+        vs = VersionSet()
+        expected = set()
+        for _ in range(40):
+            op = rng.random()
+            replica_id = rng.choice(['AA', 'BB'])
+            if op < 0.6:
+                c = rng.randint(1, 30)
+                vs.insert_version(Version(replica_id, c))
+                expected.add((replica_id, c))
+            elif op < 0.7:
+                c = rng.randint(1, 30)
+                vs.merge_one_version(Version(replica_id, c))
+                expected.update((replica_id, i) for i in range(1, c + 1))
+            else:
+                other = [Version(rng.choice(['AA', 'BB']), rng.randint(1, 30))
+                         for _ in range(rng.randint(0, 5))]
+                vs.merge(VersionSet(other))
+                expected.update((v.replica_id, v.counter) for v in other)
+
+            for replica_id in ('AA', 'BB'):
+                for c in range(1, 32):
+                    assert vs.has_version(Version(replica_id, c)) == \
+                        ((replica_id, c) in expected)
+
+
+def test_str():
+    assert str(VersionSet()) == "[ ]"
+    vs = VersionSet([Version('BB', 1), Version('AA', 2), Version('AA', 5),
+                     Version('AA', 7)])
+    assert str(vs) == "[ AA:0+[2,5,7] BB:1 ]"
+
+
+def test_snapshot():
+    vs = VersionSet([Version('AA', 1), Version('AA', 3), Version('BB', 4)])
+
+    snap = vs.snapshot()
+    vs.insert_version(Version('AA', 2))
+    vs.insert_version(Version('BB', 5))
+    snap.insert_version(Version('CC', 1))
+
+    assert vs.has_version(Version('AA', 2))
+    assert vs.has_version(Version('BB', 5))
+    assert not vs.has_version(Version('CC', 1))
+    assert not snap.has_version(Version('AA', 2))
+    assert not snap.has_version(Version('BB', 5))
+    assert snap.has_version(Version('AA', 3))
+    assert snap.has_version(Version('CC', 1))
+
+
 # vim:set ts=4 sw=4 expandtab:
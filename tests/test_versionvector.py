@@ -0,0 +1,112 @@
+from cvv.vtypes import Version, VersionVector
+
+
+def test_dominates():
+    empty = VersionVector()
+    a = VersionVector()
+    a.update_version(Version('AA', 2))
+    a.update_version(Version('BB', 1))
+    b = VersionVector()
+    b.update_version(Version('AA', 1))
+    c = VersionVector()
+    c.update_version(Version('AA', 2))
+    c.update_version(Version('CC', 1))
+
+    assert empty.dominates(empty)
+    assert a.dominates(empty)
+    assert not empty.dominates(a)
+    assert a.dominates(a)
+    assert a.dominates(b)
+    assert not b.dominates(a)
+
+    # Concurrent version vectors don't dominate each other
+    assert not a.dominates(c)
+    assert not c.dominates(a)
+
+
+def test_update_version():
+    vv = VersionVector()
+    vv.update_version(Version('AA', 0))
+    assert vv.empty()
+    assert vv == VersionVector()
+
+    vv.update_version(Version('AA', 3))
+    vv.update_version(Version('AA', 2))
+    assert vv.get_version('AA') == Version('AA', 3)
+    assert vv.get_counter('AA') == 3
+    assert vv.get_counter('BB') == 0
+    assert vv.dominates_version(Version('AA', 3))
+    assert not vv.dominates_version(Version('AA', 4))
+    assert vv.dominates_version(Version('BB', 0))
+    assert not vv.dominates_version(Version('BB', 1))
+
+
+def test_update():
+    a = VersionVector()
+    a.update_version(Version('AA', 2))
+    a.update_version(Version('BB', 1))
+    b = VersionVector()
+    b.update_version(Version('AA', 1))
+    b.update_version(Version('BB', 3))
+    b.update_version(Version('CC', 1))
+
+    a.update(b)
+    expected = VersionVector()
+    expected.update_version(Version('AA', 2))
+    expected.update_version(Version('BB', 3))
+    expected.update_version(Version('CC', 1))
+    assert a == expected
+
+
+def test_freeze():
+    vv1 = VersionVector()
+    vv1.update_version(Version('AA', 1))
+    vv1.update_version(Version('BB', 2))
+    vv2 = VersionVector()
+    vv2.update_version(Version('BB', 2))
+    vv2.update_version(Version('AA', 1))
+    assert vv1.freeze() == vv2.freeze()
+    assert hash(vv1.freeze()) == hash(vv2.freeze())
+    assert VersionVector().freeze() == ()
+
+    frozen = vv1.freeze()
+    vv1.update_version(Version('AA', 3))
+    assert vv1.freeze() != frozen
+    assert frozen == vv2.freeze()
+
+
+def test_str():
+    vv = VersionVector()
+    assert str(vv) == "[ ]"
+    vv.update_version(Version('BB', 3))
+    vv.update_version(Version('AA', 1))
+    assert str(vv) == "[ AA:1 BB:3 ]"
+
+
+def test_snapshot():
+    vv = VersionVector()
+    vv.update_version(Version('AA', 3))
+    vv.update_version(Version('BB', 1))
+
+    snap = vv.snapshot()
+    assert snap == vv
+    assert snap is not vv
+
+    assert vv.inc_version('AA') == Version('AA', 4)
+    assert snap.inc_version('CC') == Version('CC', 1)
+    assert vv.get_version('AA') == Version('AA', 4)
+    assert vv.get_version('CC') == Version('CC', 0)
+    assert snap.get_version('AA') == Version('AA', 3)
+    assert snap.get_version('CC') == Version('CC', 1)
+
+
+def test_iter_entries():
+    vv = VersionVector()
+    assert list(vv.iter_entries()) == []
+
+    vv.update_version(Version('AA', 3))
+    vv.update_version(Version('BB', 1))
+    assert sorted(vv.iter_entries()) == [('AA', 3), ('BB', 1)]
+
+
+# vim:set ts=4 sw=4 expandtab: